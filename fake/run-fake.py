@@ -1,37 +1,72 @@
 #!/usr/bin/python3
 
-from subprocess import run
-
-run(['cargo', 'build', '--release', '--bin',
-     'replicas', '--bin', 'binning'], check=True)
+import os, glob
+import asyncio
+from subprocess import run, CalledProcessError
+
+binaries = ['../target/release/replicas', '../target/release/binning']
+
+def needs_build():
+    '''true if a binary is missing or older than the rust sources or git state'''
+    try:
+        built = min(os.path.getmtime(b) for b in binaries)
+    except OSError:
+        return True
+    sources = glob.glob('../src/**/*.rs', recursive=True) + ['../Cargo.toml', '../Cargo.lock']
+    # the binaries embed `git describe --always --dirty`, so a commit,
+    # checkout or staged change must trigger a rebuild too
+    sources += ['../.git/HEAD', '../.git/index', '../.git/packed-refs']
+    try:
+        with open('../.git/HEAD') as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            sources.append('../.git/' + head[len('ref: '):])
+    except OSError:
+        pass
+    return max(os.path.getmtime(s) for s in sources if os.path.exists(s)) > built
+
+if needs_build():
+    run(['cargo', 'build', '--release', '--bin',
+         'replicas', '--bin', 'binning'], check=True)
 
 max_iter_default = 1e11
 
+# rq submissions are queued here and run concurrently by submit_all()
+jobs = []
+
 def rq(name, cmd, cpus):
-    run(f'rq run -c {cpus} --max-output=30 -R -J'.split() +
-        [name, '--']+cmd, check=True)
+    jobs.append(['rq', 'run', '-c', f'{cpus}', '--max-output=30', '-R', '-J'] +
+                [name, '--']+cmd)
+
+async def submit(cmd):
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    if await proc.wait() != 0:
+        raise CalledProcessError(proc.returncode, cmd)
 
+async def submit_all():
+    await asyncio.gather(*(submit(cmd) for cmd in jobs))
 
-movie_args = '--movie-time 10^(1/4)'.split()
+
+movie_args = ('--movie-time', '10^(1/4)')
 
 def run_replicas(name, max_iter=max_iter_default, min_T=0.001):
     save = 'r-'+name
     rq(name=save,
-       cmd=['../target/release/replicas']+systems[name]+movie_args
-        + f' --save-time 0.5 --save-as {save}.yaml'.split()
-        + f'--max-iter {max_iter} --min-T {min_T}'.split(),
+       cmd=['../target/release/replicas']+systems[name]+list(movie_args)
+        + ['--save-time', '0.5', '--save-as', f'{save}.yaml']
+        + ['--max-iter', f'{max_iter}', '--min-T', f'{min_T}'],
        cpus='all')
 
 def binning_histogram(name, de, translation_scale):
-    return f'../target/release/binning --save-time 0.5 --histogram-bin {de} --translation-scale {translation_scale}'.split()+movie_args+systems[name]
+    return ['../target/release/binning', '--save-time', '0.5', '--histogram-bin', f'{de}', '--translation-scale', f'{translation_scale}']+list(movie_args)+systems[name]
 
 def run_sad(name, de, max_iter=max_iter_default, min_T=0.001, translation_scale=0.05):
     de = str(de)
     save = 'sad-'+name+'-'+de
     rq(name=save,
        cmd=binning_histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.yaml'.split()
-        + f'--max-iter {max_iter} --sad-min-T {min_T}'.split(),
+        + ['--save-as', f'{save}.yaml']
+        + ['--max-iter', f'{max_iter}', '--sad-min-T', f'{min_T}'],
        cpus='1')
 
 
@@ -40,8 +75,8 @@ def run_wl(name, de, min_E, max_E, max_iter=max_iter_default, translation_scale=
     save = 'wl-'+name+'-'+de
     rq(name=save,
        cmd=binning_histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.yaml'.split()
-        + f'--max-iter {max_iter} --wl --min-allowed-energy {min_E} --max-allowed-energy {max_E}'.split(),
+        + ['--save-as', f'{save}.yaml']
+        + ['--max-iter', f'{max_iter}', '--wl', '--min-allowed-energy', f'{min_E}', '--max-allowed-energy', f'{max_E}'],
        cpus='1')
 
 
@@ -50,8 +85,8 @@ def run_inv_t_wl(name, de, min_E, max_E, max_iter=max_iter_default, translation_
     save = 'itwl-'+name+'-'+de
     rq(name=save,
        cmd=binning_histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.yaml'.split()
-        + f'--max-iter {max_iter} --inv-t-wl --min-allowed-energy {min_E} --max-allowed-energy {max_E}'.split(),
+        + ['--save-as', f'{save}.yaml']
+        + ['--max-iter', f'{max_iter}', '--inv-t-wl', '--min-allowed-energy', f'{min_E}', '--max-allowed-energy', f'{max_E}'],
        cpus='1')
 
 
@@ -77,3 +112,5 @@ for de in [0.001, 0.01, 0.1]:
     run_sad('linear', de=de)
     run_sad('quadratic', de=de)
     run_sad('pieces', de=de)
+
+asyncio.run(submit_all())
@@ -1,27 +1,62 @@
 #!/usr/bin/python3
 
-from subprocess import run
-
-run(['cargo', 'build', '--release', '--bin',
-     'replicas', '--bin', 'histogram'], check=True)
+import os, glob
+import asyncio
+from subprocess import run, CalledProcessError
+
+binaries = ['../target/release/replicas', '../target/release/histogram']
+
+def needs_build():
+    '''true if a binary is missing or older than the rust sources or git state'''
+    try:
+        built = min(os.path.getmtime(b) for b in binaries)
+    except OSError:
+        return True
+    sources = glob.glob('../src/**/*.rs', recursive=True) + ['../Cargo.toml', '../Cargo.lock']
+    # the binaries embed `git describe --always --dirty`, so a commit,
+    # checkout or staged change must trigger a rebuild too
+    sources += ['../.git/HEAD', '../.git/index', '../.git/packed-refs']
+    try:
+        with open('../.git/HEAD') as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            sources.append('../.git/' + head[len('ref: '):])
+    except OSError:
+        pass
+    return max(os.path.getmtime(s) for s in sources if os.path.exists(s)) > built
+
+if needs_build():
+    run(['cargo', 'build', '--release', '--bin',
+         'replicas', '--bin', 'histogram'], check=True)
 
 max_iter_default = 1e13
 
+# rq submissions are queued here and run concurrently by submit_all()
+jobs = []
+
 def rq(name, cmd, cpus):
-    run(f'rq run -c {cpus} --max-output=30 -R -J'.split() +
-        [name, '--']+cmd, check=True)
+    jobs.append(['rq', 'run', '-c', f'{cpus}', '--max-output=30', '-R', '-J'] +
+                [name, '--']+cmd)
+
+async def submit(cmd):
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    if await proc.wait() != 0:
+        raise CalledProcessError(proc.returncode, cmd)
 
+async def submit_all():
+    await asyncio.gather(*(submit(cmd) for cmd in jobs))
 
-movie_args = '--movie-time 10^(1/8)'.split()
+
+movie_args = ('--movie-time', '10^(1/8)')
 
 
 def run_replicas(name, max_iter=max_iter_default, min_T=0.001, extraname='', extraflags=''):
     save = f'r-{extraname}{name}'
     rq(name=save,
-       cmd=['../target/release/replicas']+systems[name]+movie_args
-        + f'--save-time 0.5 --save-as {save}.cbor'.split()
+       cmd=['../target/release/replicas']+systems[name]+list(movie_args)
+        + ['--save-time', '0.5', '--save-as', f'{save}.cbor']
         + extraflags.split()
-        + f'--max-iter {max_iter} --min-T {min_T}'.split(),
+        + ['--max-iter', f'{max_iter}', '--min-T', f'{min_T}'],
        cpus='all')
 
 
@@ -29,18 +64,18 @@ def run_replicas(name, max_iter=max_iter_default, min_T=0.001, extraname='', ext
 #     return f'../target/release/binning --save-time 0.5 --histogram-bin {de} --translation-scale {translation_scale}'.split()+movie_args+systems[name]
 
 def histogram(name, de, translation_scale):
-    return f'../target/release/histogram --save-time 0.5 --energy-bin {de} --translation-scale {translation_scale}'.split()+movie_args+systems[name]
+    return ['../target/release/histogram', '--save-time', '0.5', '--energy-bin', f'{de}', '--translation-scale', f'{translation_scale}']+list(movie_args)+systems[name]
 
 def run_sad(name, de, max_iter=max_iter_default, min_T=0.001, max_E=None, translation_scale=0.05):
     de = str(de)
     save = 'sad-'+name+'-'+de
     max_E_args = []
     if max_E is not None:
-        max_E_args = f'--max-allowed-energy {max_E}'.split()
+        max_E_args = ['--max-allowed-energy', f'{max_E}']
     rq(name=save,
        cmd=histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.cbor'.split()
-        + f'--max-iter {max_iter} --sad-min-T {min_T}'.split()
+        + ['--save-as', f'{save}.cbor']
+        + ['--max-iter', f'{max_iter}', '--sad-min-T', f'{min_T}']
         + max_E_args,
        cpus='1')
 
@@ -50,11 +85,11 @@ def run_wl(name, de, min_E, max_E, min_gamma=None, max_iter=max_iter_default, tr
     save = 'wl-'+name+'-'+de
     min_gamma_args = []
     if min_gamma is not None:
-        min_gamma_args = f'--wl-min-gamma {min_gamma}'.split()
+        min_gamma_args = ['--wl-min-gamma', f'{min_gamma}']
     rq(name=save,
        cmd=histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.cbor'.split()
-        + f'--max-iter {max_iter} --wl --min-allowed-energy {min_E} --max-allowed-energy {max_E}'.split()
+        + ['--save-as', f'{save}.cbor']
+        + ['--max-iter', f'{max_iter}', '--wl', '--min-allowed-energy', f'{min_E}', '--max-allowed-energy', f'{max_E}']
         + min_gamma_args,
        cpus='1')
 
@@ -64,8 +99,8 @@ def run_inv_t_wl(name, de, min_E, max_E, max_iter=max_iter_default, translation_
     save = 'itwl-'+name+'-'+de
     rq(name=save,
        cmd=histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.cbor'.split()
-        + f'--max-iter {max_iter} --inv-t-wl --min-allowed-energy {min_E} --max-allowed-energy {max_E}'.split(),
+        + ['--save-as', f'{save}.cbor']
+        + ['--max-iter', f'{max_iter}', '--inv-t-wl', '--min-allowed-energy', f'{min_E}', '--max-allowed-energy', f'{max_E}'],
        cpus='1')
 
 
@@ -76,6 +111,7 @@ systems = {
 }
 
 run_replicas(name='huge-lj31', min_T=0.001, max_iter=1e14, extraname="one-decimate-nosplit-64-", extraflags="--seed=14")
+asyncio.run(submit_all())
 exit(1)
 run_replicas(name='huge-lj31', min_T=0.001, max_iter=1e14)
 run_replicas(name='lj31', min_T=0.001, extraname='0.001-', max_iter=1e14)
@@ -88,3 +124,5 @@ for de in [0.01]: # , 1/2**10]: 0.1
     # run_wl('lj31', de=de, min_gamma=1e-10, min_E=-133.53, max_E=-110)
     run_wl('lj31', de=de, min_gamma=1e-10, min_E=-133.53, max_E=0)
     run_inv_t_wl('lj31', de=de, min_E=-133.53, max_E=0)
+
+asyncio.run(submit_all())
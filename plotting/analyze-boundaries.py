@@ -6,6 +6,9 @@ import scipy.constants as const
 import scipy.optimize as optimize
 import matplotlib.pyplot as plt
 import colorcet as cc
+from numba import njit
+
+import compute
 
 parser = argparse.ArgumentParser(description="fake energies analysis")
 parser.add_argument('base', nargs='*', help = 'the yaml or cbor file')
@@ -30,17 +33,14 @@ def other_density_of_states(E):
 def erfinv_density_of_states(E):
     return np.sqrt(np.pi/N)*np.exp(-(E - mean_erfinv_energy)**2/N)
 def piecewise_density_of_states(E):
-    if E > 0:
-        o = (b-a) * (b + (b - a)*np.sqrt(E/e2 + 1))**2 / (2*e2*np.sqrt(E/e2+1))
-    elif E > -e2:
-        o = (a**3 * np.sqrt(E+e1) / 2) + ( (b-a)*(b - (b - a)*np.sqrt(E/e2 + 1))**2 / (2*e2*np.sqrt(E/e2+1)) ) + ( (b-a) * (b + (b - a)*np.sqrt(E/e2 + 1))**2 / (2*e2*np.sqrt(E/e2+1)) )
-    else:
-        o= (a**3 * np.sqrt(E+e1) / 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sqrtp = np.sqrt(E/e2 + 1)
+        term_hi = (b-a) * (b + (b - a)*sqrtp)**2 / (2*e2*sqrtp)
+        term_lo = (b-a) * (b - (b - a)*sqrtp)**2 / (2*e2*sqrtp)
+        term_mid = a**3 * np.sqrt(E+e1) / 2
+    o = np.where(E > 0, term_hi, np.where(E > -e2, term_mid + term_lo + term_hi, term_mid))
     return 3 * o
 
-piecewise_density_of_states = np.vectorize(piecewise_density_of_states)
-#The function needs to be callable
-
 def fn_entropy(S_i_1, E_i_1, E_i, lnw_i, S_i):
     ''' This is the thing that should be zero '''
     ''' Equation initially is:
@@ -60,55 +60,67 @@ def fn_entropy(S_i_1, E_i_1, E_i, lnw_i, S_i):
     else:
         return np.log(delta_E) + S_0 - np.log((np.exp(delta_S)- 1)/delta_S) - lnw_i
 
-    denominator = np.log((S_i - S_i_1) / (E_i - E_i_1))
-    coefficient = (S_i*E_i - S_i_1*E_i_1) / (E_i - E_i_1)
-    inside = np.log(
-                    np.exp( E_i_1 * ((S_i - S_i_1) / (E_i - E_i_1)) )
-                    - np.exp( E_i * ((S_i - S_i_1) / (E_i - E_i_1)) ) 
-                    )
-    return coefficient + inside - denominator - lnw_i
-def optimize_bin_entropy(i, E_bounds, lnw, S_i):
-    #i is the bin whose entropy we are calculating
-    print('solving E_i_1', E_bounds[i-1], 'E_i', E_bounds[i], 'lnw_i', lnw[i], 'S_i', S_i)
-    sol = optimize.root(fn_entropy, [0], args=(E_bounds[i-1], E_bounds[i], lnw[i], S_i))
-    # print('   goodness is', fn_entropy(sol.x[0], E_bounds[i-1], E_bounds[i], lnw[i], S_i),
-    #       'with entropy', sol.x[0])
-    # print('      delta S =', sol.x[0] - S_i, np.exp(sol.x[0] - S_i))
-    # print('      delta E =', E_bounds[i-1] - E_bounds[i])
-    # print('      S_0 =', S_i)
-    # print('      w =', np.exp(lnw[i]))
-    # print('      S estimate =', lnw[i] - np.log(E_bounds[i-1] - E_bounds[i]))
-    
-    # plt.figure('debugging')
-    # xxx = np.linspace(-10,100, 10000)
-    # answer = np.zeros_like(xxx)
-    # for j in range(len(xxx)):
-    #     answer[j] = fn_entropy(xxx[j], E_bounds[i-1], E_bounds[i], lnw[i], S_i)
-    # plt.plot(xxx, answer)
-    # plt.show()
-    return sol.x[0]
+@njit(cache=True)
+def solve_deltaS(y):
+    ''' Solve ln(x/(1 - e^-x)) = y for x = S_{i-1} - S_i
 
-def compute_entropy_given_Smin(Smin, energy_boundaries, lnw):
-    entropy_boundaries = np.zeros_like(energy_boundaries)
+        This is fn_entropy = 0 rewritten in terms of delta_S, with
+        y = lnw_i - ln(delta_E) - S_i.  Newton's method starts from the
+        asymptotes x ~ e^y (large y) and x ~ y - ln(-y) (very negative y),
+        which converges in a few steps.  Returns nan if x overflows
+        (y > 709) or the iteration does not converge.
+    '''
+    if y > 1:
+        x = np.exp(y)
+    elif y < -2:
+        x = y - np.log(-y)
+    else:
+        x = 2*y
+    if not np.isfinite(x):
+        return np.nan
+    for _ in range(50):
+        if abs(x) < 1e-4:
+            f = 0.5*x - x*x/24
+            dfdx = 0.5 - x/12
+        else:
+            f = np.log(abs(x)) + min(x, 0.0) - np.log(-np.expm1(-abs(x)))
+            dfdx = 1/x - 1/np.expm1(x)
+        step = (f - y)/dfdx
+        x -= step
+        if abs(step) < 1e-12*max(1.0, abs(x)):
+            return x
+    return np.nan
+
+@njit(cache=True)
+def compute_entropy_given_Smin_nb(Smin, y):
+    entropy_boundaries = np.zeros_like(y)
     entropy_boundaries[-1] = Smin
-    for i in range(len(energy_boundaries)-1, 1, -1):
-        print('solving for i =', i)
-        entropy_boundaries[i-1] = optimize_bin_entropy(i, energy_boundaries, lnw, entropy_boundaries[i])
-    return entropy_boundaries    
+    for i in range(len(y)-1, 1, -1):
+        entropy_boundaries[i-1] = entropy_boundaries[i] + solve_deltaS(y[i] - entropy_boundaries[i])
+    return entropy_boundaries
+
+def compute_entropy_given_Smin(Smin, energy_boundaries, lnw):
+    # y[i] = lnw[i] - ln(delta_E) for the bin between boundaries i-1 and i;
+    # lnw has one more entry than energy_boundaries, for the unbounded low bin
+    N = len(energy_boundaries)
+    y = np.zeros(N)
+    y[1:] = lnw[1:N] - np.log(energy_boundaries[:-1] - energy_boundaries[1:])
+    return compute_entropy_given_Smin_nb(float(Smin), y)
 
 def entropy_boundary_badness(Smin, energy_boundaries, lnw):
     entropy_boundaries = compute_entropy_given_Smin(Smin, energy_boundaries, lnw)
-    badness = 0
-    for i in range(len(energy_boundaries)-2):
-        de1 = energy_boundaries[i+1] - energy_boundaries[i]
-        de2 = energy_boundaries[i+2] - energy_boundaries[i+1]
-        dS1 = entropy_boundaries[i+1] - entropy_boundaries[i]
-        dS2 = entropy_boundaries[i+2] - entropy_boundaries[i+1]
-        badness += abs((dS2/de2 - dS1/de1)/(de2+de1))
-    return badness
+    de = np.diff(energy_boundaries)
+    slopes = np.diff(entropy_boundaries)/de
+    return np.abs(np.diff(slopes)/(de[1:] + de[:-1])).sum()
 
 def optimize_entropy(energy_boundaries, lnw):
-    res = optimize.minimize_scalar(entropy_boundary_badness, args=(energy_boundaries, lnw))
+    # Smin lies close to the flat entropy of the lowest bounded bin (lnw[-1]
+    # is the unbounded one), so bracketing there saves Brent the downhill
+    # search from its default (0, 1) bracket.
+    i = len(energy_boundaries) - 1
+    S_guess = lnw[i] - np.log(energy_boundaries[i-1] - energy_boundaries[i])
+    res = optimize.minimize_scalar(entropy_boundary_badness, bracket=(S_guess - 0.1, S_guess),
+                                   args=(energy_boundaries, lnw))
     Smin = res.x
     return compute_entropy_given_Smin(Smin, energy_boundaries, lnw)
 
@@ -125,13 +137,20 @@ def find_beta_deltaE(meanE_over_deltaE):
     # x = np.linspace(-100,100,10000)
     # plt.plot(x, np.vectorize(fn_for_beta)(x, meanE_over_deltaE))
     # plt.show()
-    if meanE_over_deltaE == 0:
-        x0 = 1e-6
-        x1 = -1e-6
-    else:
-        x0 = 2*meanE_over_deltaE
-        x1 = meanE_over_deltaE
-    sol = optimize.root_scalar(fn_for_beta, args=(meanE_over_deltaE), x0 = x0, x1 = x1)
+    if np.isnan(meanE_over_deltaE):
+        return np.nan
+    # fn_for_beta is linear below x = 0, so its only nonzero root is at
+    # positive x, which exists when 1/2 < meanE_over_deltaE < 1.
+    if not 0.5 < meanE_over_deltaE < 1:
+        return 0
+    xlo = 1e-6
+    if fn_for_beta(xlo, meanE_over_deltaE) >= 0:
+        return 0
+    xhi = 1.0
+    while fn_for_beta(xhi, meanE_over_deltaE) <= 0:
+        xhi *= 2
+    sol = optimize.root_scalar(fn_for_beta, args=(meanE_over_deltaE,), bracket=(xlo, xhi),
+                               method='brentq', xtol=1e-12)
     # print(sol)
     return sol.root
 
@@ -152,16 +171,16 @@ for base in args.base:
     if '.cbor' in base or '.yaml' in base:
         base = base[:-5]
     print(base)
-    energy_boundaries[base] = np.loadtxt(base+'-energy-boundaries.dat')
-    mean_energy[base] = np.loadtxt(base+'-mean-energy.dat')
-    lnw[base] = np.loadtxt(base+'-lnw.dat')
+    energy_boundaries[base] = compute.loadtxt_cached(base+'-energy-boundaries.dat')
+    mean_energy[base] = compute.loadtxt_cached(base+'-mean-energy.dat')
+    lnw[base] = compute.loadtxt_cached(base+'-lnw.dat')
     with open(base+'-system.dat') as f:
         systems[base] = yaml.safe_load(f)
 
     if energy_boundaries[base][0] < energy_boundaries[base][-1]:
-        energy_boundaries[base] = np.flip(energy_boundaries[base])
-        mean_energy[base] = np.flip(mean_energy[base])
-        lnw[base] = np.flip(lnw[base])
+        energy_boundaries[base] = energy_boundaries[base][::-1]
+        mean_energy[base] = mean_energy[base][::-1]
+        lnw[base] = lnw[base][::-1]
 
 entropy_boundaries={}
 sigma = 1
@@ -280,10 +299,10 @@ for key in lnw:
         plt.plot(E, np.exp(Smiddle), '-', label=key + 'simplest')
         # plt.plot(E, np.exp(S), '-', label=key+' optimize_bin_entropy approx.')
         # plt.plot(E, np.exp(Sbest), '-', label=key+' smooth')
-        plt.plot(E, exact_density_of_states(E), color='#aaaaaa')
+        exact = exact_density_of_states(E)
+        plt.plot(E, exact, color='#aaaaaa')
         plt.xlabel('$E$')
         plt.ylabel('$D(E)$')
-        exact = exact_density_of_states(E)
         plt.ylim(0, 1.1*exact[exact == exact].max())
         plt.legend(loc='best')
 
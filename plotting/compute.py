@@ -1,15 +1,46 @@
 import numpy as np
-import yaml
+import yaml, os
+
+def loadtxt_cached(fname):
+    '''np.loadtxt, but keeping a binary .npy copy next to the text file
+
+    The copy is stamped with the mtime the text file had when it was
+    parsed, and is only reused while the two mtimes match, so files that
+    are still being updated by a running simulation get parsed again.
+    '''
+    npy = fname + '.npy'
+    try:
+        if os.stat(npy).st_mtime_ns == os.stat(fname).st_mtime_ns:
+            return np.load(npy)
+    except (OSError, ValueError, EOFError):
+        pass # missing, stale or unreadable copy, so parse the text again
+    # take the mtime before parsing, so a write that lands while we parse
+    # leaves the copy looking stale rather than current
+    mtime = os.stat(fname).st_mtime_ns
+    data = np.loadtxt(fname)
+    # write to a temporary file and rename it, so an interrupted or
+    # concurrent write never leaves a truncated .npy in place
+    tmp = f'{npy}.{os.getpid()}.tmp.npy'
+    try:
+        np.save(tmp, data)
+        os.utime(tmp, ns=(mtime, mtime))
+        os.replace(tmp, npy)
+    except OSError:
+        pass # e.g. a read-only directory, we just don't cache
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return data
 
 def read_file(base):
-    energy_boundaries = np.loadtxt(base+'-energy-boundaries.dat')
-    mean_energy = np.loadtxt(base+'-mean-energy.dat')
+    energy_boundaries = loadtxt_cached(base+'-energy-boundaries.dat')
+    mean_energy = loadtxt_cached(base+'-mean-energy.dat')
     excess_pressure = None
     try:
-        excess_pressure = np.loadtxt(base+'-pressure.dat')
+        excess_pressure = loadtxt_cached(base+'-pressure.dat')
     except:
         pass
-    lnw = np.loadtxt(base+'-lnw.dat')
+    lnw = loadtxt_cached(base+'-lnw.dat')
     with open(base+'-system.dat') as f:
         system = yaml.safe_load(f)
 
@@ -17,11 +48,11 @@ def read_file(base):
         energy_boundaries = np.array([energy_b.item()])
 
     if energy_boundaries[0] < energy_boundaries[-1]:
-        energy_boundaries = np.flip(energy_boundaries)
-        mean_energy = np.flip(mean_energy)
-        lnw = np.flip(lnw)
+        energy_boundaries = energy_boundaries[::-1]
+        mean_energy = mean_energy[::-1]
+        lnw = lnw[::-1]
         if excess_pressure is not None:
-            excess_pressure = np.flip(excess_pressure)
+            excess_pressure = excess_pressure[::-1]
     lnw -= lnw.max()
     lnw -= np.log(np.sum(np.exp(lnw)))
     return energy_boundaries, mean_energy, lnw, system, excess_pressure
@@ -1,10 +1,15 @@
 #!/usr/bin/python3
 
 import numpy as np
-import yaml, cbor, argparse, sys, os, glob
+import yaml, cbor, argparse, sys, os, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import scipy.constants as const
 import scipy.optimize as optimize
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib import animation
 import colorcet as cc
 
 import compute
@@ -12,6 +17,7 @@ import compute
 parser = argparse.ArgumentParser(description="fake energies analysis")
 parser.add_argument('base', nargs='*', help = 'the yaml or cbor files')
 parser.add_argument('--intensive', action='store_true')
+parser.add_argument('--movie', action='store_true', help='save the entropy of each movie frame as convergence.mp4')
 
 args = parser.parse_args()
 
@@ -64,16 +70,12 @@ def erfinv_density_of_states(E):
 def erfinv_E_from_T(T):
     return -(N/2)/T
 def piecewise_density_of_states(E):
-    # D = np.zeros_like(E)
-    # D[E>-e2] = (a**3 * np.sqrt(E[E>-e2]+e1) / 2) + ( (b - (b - a)*np.sqrt(E[E>-e2]/e2 + 1))**2 / (2*e2*np.sqrt(E[E>-e2]/e2+1)) ) + ( (b + (b - a)*np.sqrt(E[E>-e2]/e2 + 1))**2 / (2*e2*np.sqrt(E[E>-e2]/e2+1)) )
-    # D[E>0] = (b + (b - a)*np.sqrt(E[E>0]/e2 + 1))**2 / (2*e2*np.sqrt(E[E>0]/e2+1))
-    # return D
-    if E > 0:
-        return (b + (b - a)*np.sqrt(E/e2 + 1))**2 / (2*e2*np.sqrt(E/e2+1))
-    elif E > -e2:
-        return (a**3 * np.sqrt(E+e1) / 2) + ( (b - (b - a)*np.sqrt(E/e2 + 1))**2 / (2*e2*np.sqrt(E/e2+1)) ) + ( (b + (b - a)*np.sqrt(E/e2 + 1))**2 / (2*e2*np.sqrt(E/e2+1)) )
-    return 0
-piecewise_density_of_states = np.vectorize(piecewise_density_of_states)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sqrtp = np.sqrt(E/e2 + 1)
+        term_hi = (b + (b - a)*sqrtp)**2 / (2*e2*sqrtp)
+        term_lo = (b - (b - a)*sqrtp)**2 / (2*e2*sqrtp)
+        term_mid = a**3 * np.sqrt(E+e1) / 2
+    return np.where(E > 0, term_hi, np.where(E > -e2, term_mid + term_lo + term_hi, 0.0))
 
 #Read Data
 moves = {}
@@ -139,68 +141,61 @@ else:
 
 # We can compute the exact entropy now, at our energies E
 print('computing exact density of states')
-exact_entropy = np.log(exact_density_of_states(E))
+unnormalized_dos = exact_density_of_states(E)
+exact_entropy = np.log(unnormalized_dos)
 if 'pieces' in base:
     # FIXME we should properly normalize piecewise_density_of_states
-    exact_entropy -= np.log(sum(exact_density_of_states(E))*(E[1]-E[0]))
+    exact_entropy -= np.log(np.sum(unnormalized_dos)*(E[1]-E[0]))
+exact_dos = np.exp(exact_entropy)
 print('done computing exact density of states')
 
-for frame in range(10000):
-    plt.clf()
-    which_color = 0
-    plotted_something = False
-    if 'erfinv' in base:
-        plt.plot(E, exact_entropy, '--', label='exact')
-        plt.ylabel('$S(E)$')
-        plt.ylim(exact_entropy.min()*1.1 - exact_entropy.max()*0.1, -exact_entropy.min()*0.1 + exact_entropy.max()*1.1)
-    else:
-        plt.plot(E, np.exp(exact_entropy), '--', label='exact')
-        plt.ylabel('density of states')
-
+def process_frame(f, E, exact_entropy, keep_entropy):
+    f = os.path.splitext(f)[0]
+    mymove = float(os.path.basename(f))
+    print(f'working on moves {mymove} which is {f}')
+
+    energy_b = compute.loadtxt_cached(f+'-energy-boundaries.dat')
+    mean_e = compute.loadtxt_cached(f+'-mean-energy.dat')
+    my_lnw = compute.loadtxt_cached(f+'-lnw.dat')
+
+    if energy_b.ndim == 0: #in case of a single value
+        energy_b = np.array([energy_b.item()])
+
+    if energy_b[0] < energy_b[-1]:
+        energy_b = energy_b[::-1]
+        mean_e = mean_e[::-1]
+        my_lnw = my_lnw[::-1]
+
+    # Create a function for the entropy based on this number of moves:
+    l_function, _, _ = compute.linear_entropy(energy_b, mean_e, my_lnw)
+    # l_function, _, _ = compute.step_entropy(energy_b, mean_e, my_lnw)
+    entropy_here = l_function(E)
+    entropy_error = entropy_here - exact_entropy
+    max_error = np.abs(entropy_error, out=entropy_error).max()
+    if keep_entropy: # only the movie needs the whole curve
+        return mymove, max_error, entropy_here
+    return mymove, max_error
+
+# The frames are independent, so we compute them all in parallel and only
+# plot afterwards.  We fork so the workers don't rerun this script.
+movie_files = {}
+entropies = {}
+with ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork')) as executor:
+    results = {}
     for base in bases:
-        color = colors[which_color]
-        which_color += 1
-
-        if base not in moves:
-            moves[base] = []
-            error[base] = []
-        frames = sorted(glob.glob(base+'/*.cbor'))
-        if frame >= len(frames):
-            continue
-        f = os.path.splitext(frames[frame])[0]
-        mymove = float(os.path.basename(f))
-        moves[base].append(mymove)
-        print(f'working on {base} with moves {mymove} which is {f}')
-
-        energy_b = np.loadtxt(f+'-energy-boundaries.dat')
-        mean_e = np.loadtxt(f+'-mean-energy.dat')
-        my_lnw = np.loadtxt(f+'-lnw.dat')
-        
-        if energy_b.ndim == 0: #in case of a single value
-            energy_b = np.array([energy_b.item()])
-
-        if energy_b[0] < energy_b[-1]:
-            energy_b = np.flip(energy_b)
-            mean_e = np.flip(mean_e)
-            my_lnw = np.flip(my_lnw)
-
-        # Create a function for the entropy based on this number of moves:
-        l_function, _, _ = compute.linear_entropy(energy_b, mean_e, my_lnw)
-        # l_function, _, _ = compute.step_entropy(energy_b, mean_e, my_lnw)
-        entropy_here = l_function(E)
-        if 'erfinv' in base:
-            plt.plot(E, entropy_here, label=beautiful_name(f))
-        else:
-            plt.plot(E, np.exp(entropy_here), label=beautiful_name(f))
-        max_error = np.max(np.abs(entropy_here - exact_entropy))
-        error[base].append(max_error)
-        plotted_something = True
-    if not plotted_something:
-        break
-    plt.xlabel('E')
-    plt.legend()
-    plt.draw_if_interactive()
-    plt.pause(0.1)
+        movie_files[base] = []
+        if os.path.isdir(base): # a base without a movie just has no frames
+            movie_files[base] = sorted(e.path for e in os.scandir(base)
+                                       if e.name.endswith('.cbor') and not e.name.startswith('.'))
+        results[base] = executor.map(process_frame, movie_files[base], repeat(E), repeat(exact_entropy),
+                                     repeat(args.movie))
+    for base in bases:
+        moves[base], entropies[base], error[base] = [], [], []
+        for result in results[base]:
+            moves[base].append(result[0])
+            error[base].append(result[1])
+            if args.movie:
+                entropies[base].append(result[2])
 
 #Plotting
 mins = 1e10
@@ -224,4 +219,34 @@ plt.ylabel('Error (S - S$_{exact}$)')
 plt.legend(loc='best')
 plt.tight_layout()
 plt.savefig('convergence.pdf')
-plt.show()
+
+num_frames = max([len(moves[b]) for b in bases] + [0])
+if args.movie and num_frames == 0:
+    print('no movie frames found, not writing convergence.mp4')
+elif args.movie and not animation.writers.is_available('ffmpeg'):
+    print('ffmpeg is not available, not writing convergence.mp4')
+elif args.movie:
+    plot_entropy = 'erfinv' in base
+    fig, ax = plt.subplots()
+    def draw_frame(frame):
+        ax.clear()
+        if plot_entropy:
+            ax.plot(E, exact_entropy, '--', label='exact')
+            ax.set_ylabel('$S(E)$')
+            ax.set_ylim(exact_entropy.min()*1.1 - exact_entropy.max()*0.1, -exact_entropy.min()*0.1 + exact_entropy.max()*1.1)
+        else:
+            ax.plot(E, exact_dos, '--', label='exact')
+            ax.set_ylabel('density of states')
+        for b in bases:
+            if frame >= len(moves[b]):
+                continue
+            f = os.path.splitext(movie_files[b][frame])[0]
+            entropy_here = entropies[b][frame]
+            if plot_entropy:
+                ax.plot(E, entropy_here, label=beautiful_name(f))
+            else:
+                ax.plot(E, np.exp(entropy_here), label=beautiful_name(f))
+        ax.set_xlabel('E')
+        ax.legend()
+    animation.FuncAnimation(fig, draw_frame, frames=num_frames).save('convergence.mp4', fps=10)
+    plt.close(fig)
@@ -1,34 +1,57 @@
 #!/usr/bin/python3
 
 import numpy as np
+import os, glob
 from subprocess import run
 
-run(['cargo', 'build', '--release', '--bin',
-     'replicas', '--bin', 'histogram'], check=True)
+binaries = ['../target/release/replicas', '../target/release/histogram']
+
+def needs_build():
+    '''true if a binary is missing or older than the rust sources or git state'''
+    try:
+        built = min(os.path.getmtime(b) for b in binaries)
+    except OSError:
+        return True
+    sources = glob.glob('../src/**/*.rs', recursive=True) + ['../Cargo.toml', '../Cargo.lock']
+    # the binaries embed `git describe --always --dirty`, so a commit,
+    # checkout or staged change must trigger a rebuild too
+    sources += ['../.git/HEAD', '../.git/index', '../.git/packed-refs']
+    try:
+        with open('../.git/HEAD') as f:
+            head = f.read().strip()
+        if head.startswith('ref: '):
+            sources.append('../.git/' + head[len('ref: '):])
+    except OSError:
+        pass
+    return max(os.path.getmtime(s) for s in sources if os.path.exists(s)) > built
+
+if needs_build():
+    run(['cargo', 'build', '--release', '--bin',
+         'replicas', '--bin', 'histogram'], check=True)
 
 max_iter_default = 1e12
 
 
 def rq(name, cmd, cpus):
-    run(f'rq run -c {cpus} --max-output=30 -R -J'.split() +
+    run(['rq', 'run', '-c', f'{cpus}', '--max-output=30', '-R', '-J'] +
         [name, '--']+cmd, check=True)
 
 
-movie_args = '--movie-time 10^(1/8)'.split()
+movie_args = ('--movie-time', '10^(1/8)')
 
 
 def run_replicas(name, max_iter=max_iter_default, min_T=0.001, extraname='', extraflags=''):
     save = f'z-{extraname}{name}'
-    run('cargo run --bin replicas --release --'.split()+systems[name]+movie_args
-        + f'--save-time 0.5 --save-as {save}.cbor'.split()
+    run(['cargo', 'run', '--bin', 'replicas', '--release', '--']+systems[name]+list(movie_args)
+        + ['--save-time', '0.5', '--save-as', f'{save}.cbor']
         + extraflags.split()
-        + f'--max-iter {max_iter} --min-T {min_T}'.split(),
+        + ['--max-iter', f'{max_iter}', '--min-T', f'{min_T}'],
         stdout=open(save+'.out', 'a'),
         check=True)
 
 
 def histogram(name, de, translation_scale):
-    return f'../target/release/histogram --save-time 0.5 --energy-bin {de} --translation-scale {translation_scale}'.split()+movie_args+systems[name]
+    return ['../target/release/histogram', '--save-time', '0.5', '--energy-bin', f'{de}', '--translation-scale', f'{translation_scale}']+list(movie_args)+systems[name]
 
 
 def run_sad(name, de, max_iter=max_iter_default, min_T=0.001, max_E=None, translation_scale=0.05):
@@ -36,10 +59,10 @@ def run_sad(name, de, max_iter=max_iter_default, min_T=0.001, max_E=None, transl
     save = 'sad-'+name+'-'+de
     max_E_args = []
     if max_E is not None:
-        max_E_args = f'--max-allowed-energy {max_E}'.split()
+        max_E_args = ['--max-allowed-energy', f'{max_E}']
     run(histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.cbor'.split()
-        + f'--max-iter {max_iter} --sad-min-T {min_T}'.split()
+        + ['--save-as', f'{save}.cbor']
+        + ['--max-iter', f'{max_iter}', '--sad-min-T', f'{min_T}']
         + max_E_args, check=True)
 
 
@@ -48,10 +71,10 @@ def run_wl(name, de, min_E, max_E, min_gamma=None, max_iter=max_iter_default, tr
     save = 'wl-'+name+'-'+de
     min_gamma_args = []
     if min_gamma is not None:
-        min_gamma_args = f'--wl-min-gamma {min_gamma}'.split()
+        min_gamma_args = ['--wl-min-gamma', f'{min_gamma}']
     run(histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.cbor'.split()
-        + f'--max-iter {max_iter} --wl --min-allowed-energy {min_E} --max-allowed-energy {max_E}'.split()
+        + ['--save-as', f'{save}.cbor']
+        + ['--max-iter', f'{max_iter}', '--wl', '--min-allowed-energy', f'{min_E}', '--max-allowed-energy', f'{max_E}']
         + min_gamma_args, check=True)
 
 
@@ -59,8 +82,8 @@ def run_inv_t_wl(name, de, min_E, max_E, max_iter=max_iter_default, translation_
     de = str(de)
     save = 'itwl-'+name+'-'+de
     run(histogram(name, de, translation_scale=translation_scale)
-        + f'--save-as {save}.cbor'.split()
-        + f'--max-iter {max_iter} --inv-t-wl --min-allowed-energy {min_E} --max-allowed-energy {max_E}'.split(), check=True)
+        + ['--save-as', f'{save}.cbor']
+        + ['--max-iter', f'{max_iter}', '--inv-t-wl', '--min-allowed-energy', f'{min_E}', '--max-allowed-energy', f'{max_E}'], check=True)
 
 
 volumes = np.arange(1.0, 2.501, 0.5)